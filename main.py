@@ -1,14 +1,43 @@
+import hashlib
+import hmac
 import os
+import shutil
+import threading
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, and local runs use a single worker
+    fcntl = None
 
-from sqlalchemy import Column, String, DateTime, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, Field
+
+import anyio
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+    Index,
+    bindparam,
+    create_engine,
+    event,
+    select,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, deferred, sessionmaker
 
 
 # ---------------------------------------------------------
@@ -18,11 +47,45 @@ from sqlalchemy.orm import declarative_base, sessionmaker
 Base = declarative_base()
 DATABASE_URL = "sqlite:///./sensus.db"
 
+# sync handlers run on AnyIO's worker threads, which default to 40
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+POOL_SIZE = 10
+
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False},
+    # timeout is sqlite3's busy handler: wait up to 30s for the write lock
+    connect_args={"check_same_thread": False, "timeout": 30},
+    # a handler holds at most one connection, so room for one per worker
+    # thread means checkout never waits out pool_timeout behind the limiter;
+    # overflow connections are closed again once returned
+    pool_size=POOL_SIZE,
+    max_overflow=max(THREADPOOL_SIZE - POOL_SIZE, 0),
+    pool_recycle=-1,
+    query_cache_size=1200,
 )
-SessionLocal = sessionmaker(bind=engine)
+
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets GETs read while a POST commits; NORMAL skips the per-commit fsync
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+# connections are already pooled; keeping attributes loaded after commit
+# avoids a reload SELECT when a handler reads the user back
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
 
 def get_db():
@@ -41,18 +104,260 @@ def normalize_user_id(raw: str) -> str:
     return raw.strip()
 
 
-def touch(user):
-    user.updated_at = datetime.utcnow()
+COPY_CHUNK = 1 << 20
+
+
+def file_digest(f) -> bytes:
+    digest = hashlib.blake2b()
+    while chunk := f.read(COPY_CHUNK):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def same_content(src, path: str) -> bool:
+    size = src.seek(0, os.SEEK_END)
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        with open(path, "rb") as f:
+            existing = file_digest(f)
+    except FileNotFoundError:
+        return False
+
+    src.seek(0)
+    return file_digest(src) == existing
+
+
+def save_screenshot(upload: UploadFile, path: str):
+    src = upload.file
+
+    # Shortcuts retries resend the same image; leaving the file untouched
+    # also keeps its mtime, and so the screenshot ETag, stable
+    if same_content(src, path):
+        return
+
+    src.seek(0)
+
+    # spooled uploads past the memory threshold live in a real temp file,
+    # which the kernel can copy without a round trip through Python
+    if getattr(src, "_rolled", True) and hasattr(os, "copy_file_range"):
+        try:
+            src_fd = src.fileno()
+            dst_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except (AttributeError, OSError):
+            pass
+        else:
+            try:
+                while os.copy_file_range(src_fd, dst_fd, COPY_CHUNK):
+                    pass
+                return
+            except OSError:
+                src.seek(0)
+            finally:
+                os.close(dst_fd)
+
+    with open(path, "wb") as f:
+        shutil.copyfileobj(src, f, COPY_CHUNK)
+
+
+# 19 MiB, t=2, p=1 is OWASP's argon2id baseline (argon2-cffi defaults to
+# 64 MiB); check_needs_rehash migrates older hashes on login
+PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# every hash/verify allocates memory_cost; capping how many run at once keeps
+# a login burst across THREADPOOL_SIZE threads under ~76 MiB on a 512 MB box
+HASH_SLOTS = threading.BoundedSemaphore(4)
+
+
+def hash_password(password: str) -> str:
+    with HASH_SLOTS:
+        return PASSWORD_HASHER.hash(password)
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith("$argon2")
+
+
+def verify_password(stored: str, password: str) -> bool:
+    if is_hashed(stored):
+        try:
+            with HASH_SLOTS:
+                return PASSWORD_HASHER.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    # rows created before hashing still hold the plaintext
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+def screenshot_path(user_id: str) -> str:
+    # ids are free-form text at signup; never let one name a file outside
+    # UPLOAD_DIR or a hidden file inside it
+    name = f"{user_id}.png"
+    if os.path.basename(name) != name or name.startswith(".") or "\0" in name:
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    return os.path.join(UPLOAD_DIR, name)
 
 
 def get_user_or_404(db, user_id: str):
-    user_id = normalize_user_id(user_id)
-    user = db.query(User).filter(User.user_id == user_id).first()
+    # expects an already-normalized id
+    user = db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
+# ---------------------------------------------------------
+# CACHE
+# ---------------------------------------------------------
+
+PEEK_FIELDS = {
+    "data_peek": ("first_name", "last_name", "phone_number", "birthday", "address"),
+    "note_peek": ("note_name", "note_body"),
+    "screen_peek": ("contact", "url", "screenshot_path"),
+}
+SNAPSHOT_FIELDS = tuple(field for fields in PEEK_FIELDS.values() for field in fields)
+
+# user_id -> peek fields plus each split pre-serialized to JSON bytes
+# with its ETag, dropped on every write. Writes only invalidate this
+# process's cache, so the short TTL bounds staleness across workers.
+USER_CACHE = TTLCache(maxsize=1024, ttl=5)
+USER_CACHE_LOCK = threading.Lock()
+# user_id -> count of invalidations, so a fill that raced a write is dropped
+USER_GENERATION = {}
+
+
+def get_snapshot(user_id: str) -> dict:
+    user_id = normalize_user_id(user_id)
+    with USER_CACHE_LOCK:
+        snapshot = USER_CACHE.get(user_id)
+        generation = USER_GENERATION.get(user_id, 0)
+    if snapshot is not None:
+        return snapshot
+
+    # only the peek columns, straight into a dict without building a User
+    with engine.connect() as conn:
+        row = conn.execute(SELECT_SNAPSHOT, {"uid": user_id}).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    fields = dict(row._mapping)
+    rendered = {
+        split: orjson.dumps({field: fields[field] for field in split_fields})
+        for split, split_fields in PEEK_FIELDS.items()
+    }
+    snapshot = {
+        "fields": fields,
+        "json": rendered,
+        "etag": {split: etag_for(body) for split, body in rendered.items()},
+    }
+    # skip the store if a write invalidated this user after we read its
+    # generation: our row may predate that commit
+    with USER_CACHE_LOCK:
+        if USER_GENERATION.get(user_id, 0) == generation:
+            USER_CACHE[user_id] = snapshot
+    return snapshot
+
+
+def etag_for(body: bytes) -> str:
+    # weak: GZipMiddleware sends gzip and identity bodies under the same tag
+    return 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses weak comparison: a list of tags, "*", W/ ignored
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+def get_peek(user_id: str, split: str, request: Request) -> Response:
+    snapshot = get_snapshot(user_id)
+    headers = {"ETag": snapshot["etag"][split]}
+
+    # polling clients that already have this version get an empty 304
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    return Response(
+        content=snapshot["json"][split],
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def invalidate_user(user_id: str):
+    with USER_CACHE_LOCK:
+        USER_CACHE.pop(user_id, None)
+        USER_GENERATION[user_id] = USER_GENERATION.get(user_id, 0) + 1
+
+
+# ---------------------------------------------------------
+# UPDATES
+# ---------------------------------------------------------
+
+def write_changes(db, user_id: str, changes: dict, now: datetime) -> bool:
+    result = db.execute(UPDATE_USER, {"uid": user_id, **changes, "updated_at": now})
+    return result.rowcount > 0
+
+
+def apply_changes(db, user_id: str, changes: dict):
+    # expects an already-normalized id
+    # nothing to write: skip the UPDATE and commit, but answer as before
+    if not changes:
+        get_user_or_404(db, user_id)
+        return {"status": "updated"}
+
+    if not write_changes(db, user_id, changes, datetime.utcnow()):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    db.commit()
+    invalidate_user(user_id)
+    return {"status": "updated"}
+
+
+def payload_changes(payload: BaseModel) -> dict:
+    # fields the client actually sent, skipping nulls (merge-safe updates)
+    changes = {}
+    for name in payload.model_fields_set:
+        value = getattr(payload, name)
+        if value is not None:
+            changes[name] = value
+    return changes
+
+
+def apply_update(db, user_id: str, payload: BaseModel):
+    return apply_changes(db, user_id, payload_changes(payload))
+
+
+def apply_batch_update(db, items: list):
+    now = datetime.utcnow()
+    # ordered and de-duplicated, so a repeated user_id is counted once
+    updated, missing = {}, {}
+
+    for item in items:
+        user_id = normalize_user_id(item.user_id)
+        changes = payload_changes(item.fields)
+        if changes:
+            found = write_changes(db, user_id, changes, now)
+        else:
+            found = db.get(User, user_id) is not None
+
+        if not found:
+            missing[user_id] = None
+        elif changes:
+            updated[user_id] = None
+
+    # one commit for the whole batch
+    db.commit()
+    for user_id in updated:
+        invalidate_user(user_id)
+    return {"status": "updated", "updated": len(updated), "missing": list(missing)}
+
+
 # ---------------------------------------------------------
 # MODEL
 # ---------------------------------------------------------
@@ -72,7 +377,8 @@ class User(Base):
 
     # note peek
     note_name = Column(String)
-    note_body = Column(String)
+    # unbounded text; only loaded when accessed (snapshots select it explicitly)
+    note_body = deferred(Column(String))
 
     # screen peek
     contact = Column(String)
@@ -82,8 +388,44 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
 
+    # for "changed since" polling
+    __table_args__ = (Index("ix_users_updated_at", "updated_at"),)
+
+
+MIGRATE_LOCK_PATH = "sensus.db.migrate.lock"
+
+
+def init_db():
+    # with several workers, the first to take the lock creates the schema
+    # and the rest find it in place instead of racing for the write lock
+    # closing the file releases the lock
+    with open(MIGRATE_LOCK_PATH, "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # one connection and transaction for every check and DDL statement
+        with engine.begin() as conn:
+            Base.metadata.create_all(bind=conn)
+
+            # create_all skips indexes on tables that already exist
+            for index in User.__table__.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+
+# ---------------------------------------------------------
+# STATEMENTS
+# ---------------------------------------------------------
+
+# built once at import; SET columns for UPDATE_USER come from the params
+users = User.__table__
 
-Base.metadata.create_all(bind=engine)
+SELECT_SNAPSHOT = select(*(users.c[field] for field in SNAPSHOT_FIELDS)).where(
+    users.c.user_id == bindparam("uid")
+)
+
+INSERT_USER = sqlite_insert(users).on_conflict_do_nothing(index_elements=["user_id"])
+
+UPDATE_USER = update(users).where(users.c.user_id == bindparam("uid"))
 
 
 # ---------------------------------------------------------
@@ -101,36 +443,92 @@ class LoginRequest(BaseModel):
 
 
 class DataPeekUpdate(BaseModel):
-    first_name: Optional[str]
-    last_name: Optional[str]
-    phone_number: Optional[str]
-    birthday: Optional[str]
-    address: Optional[str]
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    phone_number: Optional[str] = None
+    birthday: Optional[str] = None
+    address: Optional[str] = None
 
 
 class NotePeekUpdate(BaseModel):
-    note_name: Optional[str]
-    note_body: Optional[str]
+    note_name: Optional[str] = None
+    note_body: Optional[str] = None
+
+
+class DataPeekBatchItem(BaseModel):
+    user_id: str
+    fields: DataPeekUpdate
+
+
+# one batch is one write transaction; keep it short so other writers
+# don't wait out the busy timeout behind it
+MAX_BATCH_ITEMS = 500
+
+
+class DataPeekBatch(BaseModel):
+    items: List[DataPeekBatchItem] = Field(max_length=MAX_BATCH_ITEMS)
+
+
+class NotePeekBatchItem(BaseModel):
+    user_id: str
+    fields: NotePeekUpdate
+
+
+class NotePeekBatch(BaseModel):
+    items: List[NotePeekBatchItem] = Field(max_length=MAX_BATCH_ITEMS)
+
+
+# response models let FastAPI serialize straight to JSON bytes via pydantic-core
+
+class StatusResponse(BaseModel):
+    status: str
+
+
+class CreateUserResponse(BaseModel):
+    status: str
+    user_id: str
+
+
+class BatchResponse(BaseModel):
+    status: str
+    updated: int
+    missing: List[str]
 
 
 # ---------------------------------------------------------
 # APP
 # ---------------------------------------------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await anyio.to_thread.run_sync(init_db)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "If-None-Match"],
+    expose_headers=["ETag"],
 )
 
+# note bodies and addresses compress well; PNG screenshots are skipped
+# by the middleware's default excluded content types
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# screenshots are saved as {user_id}.png, so clients can fetch them directly
+# without a database lookup; StaticFiles handles ETag/304 itself
+app.mount("/screens", StaticFiles(directory=UPLOAD_DIR), name="screens")
 
-@app.get("/")
+
+@app.get("/", response_model=StatusResponse)
 def root():
     return {"status": "ok"}
 
@@ -139,31 +537,34 @@ def root():
 # AUTH
 # ---------------------------------------------------------
 
-@app.post("/auth/create_user")
+@app.post("/auth/create_user", response_model=CreateUserResponse)
 def create_user(payload: CreateUserRequest, db=Depends(get_db)):
     user_id = normalize_user_id(payload.user_id)
 
-    existing = db.query(User).filter(User.user_id == user_id).first()
-    if existing:
+    result = db.execute(
+        INSERT_USER, {"user_id": user_id, "password": hash_password(payload.password)}
+    )
+    if result.rowcount == 0:
         raise HTTPException(status_code=409, detail="User already exists")
 
-    user = User(
-        user_id=user_id,
-        password=payload.password,
-    )
-    db.add(user)
     db.commit()
     return {"status": "created", "user_id": user_id}
 
 
-@app.post("/auth/login")
+@app.post("/auth/login", response_model=StatusResponse)
 def login(payload: LoginRequest, db=Depends(get_db)):
-    user_id = normalize_user_id(payload.user_id)
-    user = db.query(User).filter(User.user_id == user_id).first()
+    user = db.get(User, normalize_user_id(payload.user_id))
 
-    if not user or user.password != payload.password:
+    stored = user.password if user else None
+
+    if not stored or not verify_password(stored, payload.password):
         raise HTTPException(status_code=403, detail="Invalid credentials")
 
+    # upgrade plaintext rows and outdated hash parameters on successful login
+    if not is_hashed(stored) or PASSWORD_HASHER.check_needs_rehash(stored):
+        user.password = hash_password(payload.password)
+        db.commit()
+
     return {"status": "ok"}
 
 
@@ -172,28 +573,18 @@ def login(payload: LoginRequest, db=Depends(get_db)):
 # ---------------------------------------------------------
 
 @app.get("/data_peek/{user_id}")
-def get_data_peek(user_id: str, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
-    return {
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "phone_number": user.phone_number,
-        "birthday": user.birthday,
-        "address": user.address,
-    }
+def get_data_peek(user_id: str, request: Request):
+    return get_peek(user_id, "data_peek", request)
 
 
-@app.post("/data_peek/{user_id}")
-def update_data_peek(user_id: str, payload: DataPeekUpdate, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
+@app.post("/batch/data_peek", response_model=BatchResponse)
+def update_data_peek_batch(payload: DataPeekBatch, db=Depends(get_db)):
+    return apply_batch_update(db, payload.items)
 
-    for k, v in payload.dict().items():
-        if v is not None:
-            setattr(user, k, v)
 
-    touch(user)
-    db.commit()
-    return {"status": "updated"}
+@app.post("/data_peek/{user_id}", response_model=StatusResponse)
+def update_data_peek(user_id: str, payload: DataPeekUpdate, db=Depends(get_db)):
+    return apply_update(db, normalize_user_id(user_id), payload)
 
 
 # ---------------------------------------------------------
@@ -201,26 +592,18 @@ def update_data_peek(user_id: str, payload: DataPeekUpdate, db=Depends(get_db)):
 # ---------------------------------------------------------
 
 @app.get("/note_peek/{user_id}")
-def get_note_peek(user_id: str, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
-    return {
-        "note_name": user.note_name,
-        "note_body": user.note_body,
-    }
+def get_note_peek(user_id: str, request: Request):
+    return get_peek(user_id, "note_peek", request)
 
 
-@app.post("/note_peek/{user_id}")
-def update_note_peek(user_id: str, payload: NotePeekUpdate, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
+@app.post("/batch/note_peek", response_model=BatchResponse)
+def update_note_peek_batch(payload: NotePeekBatch, db=Depends(get_db)):
+    return apply_batch_update(db, payload.items)
 
-    if payload.note_name is not None:
-        user.note_name = payload.note_name
-    if payload.note_body is not None:
-        user.note_body = payload.note_body
 
-    touch(user)
-    db.commit()
-    return {"status": "updated"}
+@app.post("/note_peek/{user_id}", response_model=StatusResponse)
+def update_note_peek(user_id: str, payload: NotePeekUpdate, db=Depends(get_db)):
+    return apply_update(db, normalize_user_id(user_id), payload)
 
 
 # ---------------------------------------------------------
@@ -228,46 +611,49 @@ def update_note_peek(user_id: str, payload: NotePeekUpdate, db=Depends(get_db)):
 # ---------------------------------------------------------
 
 @app.get("/screen_peek/{user_id}")
-def get_screen_peek(user_id: str, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
-    return {
-        "contact": user.contact,
-        "url": user.url,
-        "screenshot_path": user.screenshot_path,
-    }
+def get_screen_peek(user_id: str, request: Request):
+    return get_peek(user_id, "screen_peek", request)
 
 
 @app.get("/screen_peek/{user_id}/screenshot")
-def get_screenshot(user_id: str, db=Depends(get_db)):
-    user = get_user_or_404(db, user_id)
+def get_screenshot(user_id: str, request: Request):
+    path = get_snapshot(user_id)["fields"]["screenshot_path"]
 
-    if not user.screenshot_path or not os.path.exists(user.screenshot_path):
+    try:
+        st = os.stat(path) if path else None
+    except FileNotFoundError:
+        st = None
+    if st is None:
         raise HTTPException(status_code=404, detail="No screenshot")
 
-    return FileResponse(user.screenshot_path)
+    headers = {
+        "ETag": f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"',
+        # same URL for every upload: always revalidate, the ETag makes it cheap
+        "Cache-Control": "no-cache",
+    }
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, stat_result=st, headers=headers)
 
 
-@app.post("/screen_peek/{user_id}")
-async def update_screen_peek(
+@app.post("/screen_peek/{user_id}", response_model=StatusResponse)
+def update_screen_peek(
     user_id: str,
     screenshot: UploadFile = File(None),
     contact: Optional[str] = Form(None),
     url: Optional[str] = Form(None),
     db=Depends(get_db),
 ):
-    user = get_user_or_404(db, user_id)
+    user_id = normalize_user_id(user_id)
+    changes = {"contact": contact, "url": url}
+    changes = {k: v for k, v in changes.items() if v is not None}
 
     if screenshot:
-        path = os.path.join(UPLOAD_DIR, f"{user.user_id}.png")
-        with open(path, "wb") as f:
-            f.write(await screenshot.read())
-        user.screenshot_path = path
-
-    if contact is not None:
-        user.contact = contact
-    if url is not None:
-        user.url = url
+        # only write files for known users; the path is built from the stored id
+        user = get_user_or_404(db, user_id)
+        path = screenshot_path(user.user_id)
+        save_screenshot(screenshot, path)
+        changes["screenshot_path"] = path
 
-    touch(user)
-    db.commit()
-    return {"status": "updated"}
+    return apply_changes(db, user_id, changes)
@@ -1,17 +1,41 @@
 import os
+from functools import lru_cache
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
 from pywebpush import webpush, WebPushException
-import json
 
 VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY")
 VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")
 
+# one keep-alive session so repeat pushes to the same push service
+# reuse the TLS connection instead of handshaking every time
+PUSH_SESSION = requests.Session()
+PUSH_SESSION.mount("https://", HTTPAdapter(pool_connections=50, pool_maxsize=100))
+
+
+@lru_cache(maxsize=1)
+def vapid_key():
+    # parse the key once instead of on every webpush() call; when it is
+    # unset, pass None through so webpush raises its own WebPushException
+    if not VAPID_PRIVATE_KEY:
+        return None
+    if os.path.isfile(VAPID_PRIVATE_KEY):
+        return Vapid.from_file(private_key_file=VAPID_PRIVATE_KEY)
+    return Vapid.from_string(private_key=VAPID_PRIVATE_KEY)
+
+
 def send_push(subscription, title, body):
     try:
         webpush(
             subscription_info=subscription,
-            data=json.dumps({"title": title, "body": body}),
-            vapid_private_key=VAPID_PRIVATE_KEY,
+            data=orjson.dumps({"title": title, "body": body}),
+            vapid_private_key=vapid_key(),
             vapid_claims={"sub": "mailto:admin@sensus-app.com"},
+            requests_session=PUSH_SESSION,
         )
     except WebPushException as exc:
         print("Web push failed:", exc)
+